@@ -10,11 +10,11 @@ with open('README.md', 'r') as fi:
 
 EXTRAS = {
     'record': [
-        'streamlink>=5.5.0',
-        'parse>=1.19.0'
+        'streamlink>=5.5.0'
     ],
     'offset': [
-        'praat-parselmouth>=0.4'
+        'numpy',
+        'scipy>=1.4.0'
     ],
     'mute': [
         'spleeter>=2.3.0'
@@ -1,25 +1,99 @@
 import os
-import json
 
-from multiprocessing.pool import ThreadPool
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+from collections import deque
+from contextlib import closing
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from subprocess import Popen, run, PIPE
-from typing import List, Tuple
+from typing import Deque, Iterator, List, Tuple
+
+from .utils import tmpfile, FFMPEG, FFPROBE
+
+
+FFMPEG_COMMAND = (FFMPEG, '-y', '-v', 'error')
+FFPROBE_COMMAND = (FFPROBE, '-v', 'error')
+
+
+def _ffprobe(path: str, entries: str, stream: str = None) -> dict:
+    command = [*FFPROBE_COMMAND, '-of', 'json', '-show_entries', entries]
+
+    if stream:
+        command += ['-select_streams', stream]
+
+    command += [path]
+
+    proc = run(command, stdout=PIPE, close_fds=False)
+    return json.loads(proc.stdout)
+
+
+@lru_cache(maxsize=256)
+def _ffprobe_cached(path: str, size: int, mtime: int,
+                    entries: str, stream: str = None) -> dict:
+    # size and mtime are only used as a part of the cache key
+    return _ffprobe(path, entries, stream)
+
+
+def _keyframes(path: str) -> Tuple[float, float, bool]:
+    command = [*FFPROBE_COMMAND,
+               '-of', 'csv=p=0',
+               '-show_frames',
+               '-select_streams', 'v:0',
+               '-skip_frame', 'nokey',
+               '-show_entries', 'frame=pts_time',
+               path]
+
+    ff = Popen(command, stdout=PIPE, close_fds=False)
+
+    # ffprobe never stops on its own, so the whole output can't be
+    # read at once. Take whatever is available and split it in C.
+    data = b''
+    while data.count(b'\n') < 3:
+        buf = ff.stdout.read1(4096)
+
+        if not buf:
+            break
+
+        data += buf
+
+    frames = [float(line) for line in data.splitlines()[:3]]
+
+    # Closing the pipe first makes ffprobe fail on the next write
+    # instead of reading further while SIGTERM is being delivered
+    ff.stdout.close()
+    ff.terminate()
+    ff.wait()
+
+    offset = frames[0]
+    step = frames[1] - offset
+    monotonous = (frames[2] - offset - step * 2) == 0
 
-from .utils import tmpfile
+    return offset, step, monotonous
+
+
+@lru_cache(maxsize=256)
+def _keyframes_cached(path: str, size: int,
+                      mtime: int) -> Tuple[float, float, bool]:
+    # size and mtime are only used as a part of the cache key
+    return _keyframes(path)
 
 
 class Clip(object):
     def ffprobe(self, entries, stream=None) -> dict:
-        command = ['ffprobe', '-v', 'error', '-of', 'json',
-                   '-show_entries', entries]
-
-        if stream:
-            command += ['-select_streams', stream]
+        """Returns ffprobe's output as a dict.
 
-        command += [self.path]
+        Results for local files are cached until the file is modified.
+        """
+        if not os.path.isfile(self.path):  # URLs, pipes, etc.
+            return _ffprobe(self.path, entries, stream)
 
-        proc = run(command, stdout=PIPE)
-        return json.loads(proc.stdout)
+        st = os.stat(self.path)
+        return _ffprobe_cached(self.path, st.st_size, st.st_mtime_ns,
+                               entries, stream)
 
     def __init__(self, path: str, container: str = 'wav', tmpfile = None):
         self.name = os.path.basename(path)
@@ -28,7 +102,12 @@ class Clip(object):
 
         self.container = container
 
-        info = self.ffprobe('format=duration,start_time')['format']
+        info = self.ffprobe('format=duration,start_time'
+                            ':stream=index,codec_type,codec_name,bit_rate')
+
+        self.streams = info.get('streams', [])
+
+        info = info['format']
         if 'start_time' in info:  ## MPEG-TS only
             self.start = float(info['start_time'])
         else:
@@ -43,31 +122,21 @@ class Clip(object):
         self.outpoint = self.end
 
     def keyframes(self) -> Tuple[float, float, bool]:
-        command = ['ffprobe',
-                   '-v', 'error',
-                   '-of', 'csv',
-                   '-show_frames', 
-                   '-select_streams', 'v:0',
-                   '-skip_frame', 'nokey',
-                   '-show_entries', 'frame=pts_time',
-                   self.path]
-
-        ff = Popen(command, stdout=PIPE)
-        
-        frames = []
-        for i, line in enumerate(ff.stdout):
-            frames.append(float(line.decode().split(',')[1]))
-
-            if i >= 2: break
+        """Returns offset and step of keyframes in the video track and
+        whether the first three keyframes are evenly spaced.
 
-        ff.terminate()
-        ff.wait()
+        Results for local files are cached until the file is modified.
+        """
+        if not os.path.isfile(self.path):
+            return _keyframes(self.path)
 
-        offset = frames[0]
-        step = frames[1] - offset
-        monotonous = (frames[2] - offset - step * 2) == 0
+        st = os.stat(self.path)
+        return _keyframes_cached(self.path, st.st_size, st.st_mtime_ns)
 
-        return offset, step, monotonous
+    @property
+    def audio_streams(self) -> List[dict]:
+        return [stream for stream in self.streams
+                if stream.get('codec_type') == 'audio']
 
     @property
     def duration(self):
@@ -80,16 +149,25 @@ class Clip(object):
 
     def __del__(self):
         if self._tmpfile:
-            os.unlink(self._tmpfile)
+            try:
+                os.unlink(self._tmpfile)
+            except FileNotFoundError:
+                pass  # tmpdir may have already been removed at exit
 
     def slice(self, start: float, duration: float, chunks: int = 1,
-              output_options: List[str] = []):
+              output_options: List[str] = [], threads: int = None):
         """Split this Clip into one or multiple temporary Clips.
 
         By default splits only the audio track, outputting chunks
-        in WAV format.
+        in WAV format. If `threads` is set, it limits the number of
+        threads used by ffmpeg for both decoding and encoding.
         """
-        command = (f'ffmpeg -y -v error -ss {start}').split()
+        command = [*FFMPEG_COMMAND, '-ss', str(start)]
+
+        if threads:
+            command += ['-threads', str(threads)]
+            output_options = ['-threads', str(threads)] + output_options
+
         command += ['-i', self.path]
 
         if start > self.duration:
@@ -105,15 +183,15 @@ class Clip(object):
                 break
 
             tmp_file_name = tmpfile()
-            output = (f'-f {self.container} '
-                      f'-ss {duration * i} '
-                      f'-t {duration}').split()
+            output = ['-f', self.container,
+                      '-ss', str(duration * i),
+                      '-t', str(duration)]
             output += output_options
             output += [tmp_file_name]
             command += output
             results += [tmp_file_name]
 
-        if run(command).returncode != 0:
+        if run(command, close_fds=False).returncode != 0:
             [os.unlink(chunk) for chunk in results]
             raise Exception('ffmpeg exited with non-zero code')
 
@@ -122,46 +200,179 @@ class Clip(object):
                      container=self.container)
                 for chunk in results]
 
+    @staticmethod
+    def _positions(duration: float, start: float, end: float,
+                   reverse: bool = False) -> Iterator[float]:
+        if not reverse:
+            position = start
+        else:
+            position = end - duration
+
+        while (position < end) if not reverse else (position > start):
+            yield position
+
+            if not reverse:
+                position += duration
+            else:
+                position -= duration
+
+    def read_pcm(self, start: float, duration: float, ar: int,
+                 threads: int = None, ac: int = 1,
+                 fmt: str = 's16le') -> bytes:
+        """Decode a part of the audio track into raw PCM samples.
+
+        By default returns mono signed 16-bit little-endian samples
+        (s16le) with sampling frequency `ar`. Multiple channels are
+        interleaved.
+        """
+        command = [*FFMPEG_COMMAND, '-ss', str(start)]
+
+        if threads:
+            command += ['-threads', str(threads)]
+
+        command += ['-i', self.path, '-t', str(duration), '-vn',
+                    '-ac', str(ac), '-ar', str(ar), '-f', fmt, '-']
+
+        proc = run(command, stdout=PIPE, close_fds=False)
+
+        if proc.returncode != 0:
+            raise Exception('ffmpeg exited with non-zero code')
+
+        return proc.stdout
+
+    def _prefetch(self, func, duration: float,
+                  start: float = None, end: float = None,
+                  reverse: bool = False, workers: int = None,
+                  **kwargs):
+        """Call func(position, duration) for consecutive chunks.
+
+        Up to `workers` calls are running concurrently ahead of the
+        consumer. Results are always yielded in order.
+        """
+        if not start:
+            start = 0
+
+        if not end:
+            end = self.duration
+
+        if not workers:
+            workers = min(os.cpu_count() or 1, 4)
+
+        # Share available cores between concurrent ffmpeg processes
+        kwargs.setdefault('threads', max(1, (os.cpu_count() or 1) // workers))
+
+        positions = self._positions(duration, start, end, reverse)
+        pending: Deque[Tuple[float, Future]] = deque()
+
+        with ThreadPoolExecutor(workers) as pool:
+            def submit():
+                position = next(positions, None)
+
+                if position is not None:
+                    future = pool.submit(func, position, duration, **kwargs)
+                    pending.append((position, future))
+
+            for _ in range(workers):
+                submit()
+
+            try:
+                while pending:
+                    position, future = pending.popleft()
+                    result = future.result()
+                    submit()
+                    yield position, result
+            finally:
+                for _, future in pending:
+                    future.cancel()
+
     def slice_generator(self, duration: float,
                         start: float = None, end: float = None,
-                        reverse: bool = False, **kwargs):
-        pool = ThreadPool(1)
+                        reverse: bool = False, workers: int = None,
+                        **kwargs):
+        """Yield (position, Clip) pairs for consecutive chunks.
+
+        Up to `workers` chunks are sliced concurrently ahead of the
+        consumer. Results are always yielded in order.
+        """
         kwargs['chunks'] = 1
 
+        with closing(self._prefetch(self.slice, duration, start, end,
+                                    reverse, workers, **kwargs)) as chunks:
+            for position, clips in chunks:
+                if clips:
+                    yield position, clips[0]
+
+    def pcm_generator(self, duration: float, ar: int,
+                      start: float = None, end: float = None,
+                      reverse: bool = False, workers: int = None,
+                      transform=None, overlap: float = 0):
+        """Yield (position, samples) pairs for consecutive chunks.
+
+        Samples are in the format returned by read_pcm(). Up to
+        `workers` chunks are decoded concurrently ahead of the consumer.
+        If `transform` is set, it is applied to samples in the worker
+        threads and its result is yielded instead. Each chunk is extended
+        by `overlap` seconds into the next one, but never past `end`.
+        """
+        if not end:
+            end = self.duration
+
+        def func(position, duration, **kwargs):
+            length = min(duration + overlap, end - position)
+            data = self.read_pcm(position, length, **kwargs)
+            return transform(data) if transform else data
+
+        with closing(self._prefetch(func, duration, start, end,
+                                    reverse, workers, ar=ar)) as chunks:
+            yield from chunks
+
+    def pcm_stream(self, duration: float, ar: int,
+                   start: float = None, end: float = None,
+                   transform=None, overlap: float = 0):
+        """Same as pcm_generator(), but decodes all chunks in order
+        with a single ffmpeg process.
+
+        Useful for inputs that are expensive to seek, such as URLs.
+        """
         if not start:
             start = 0
 
         if not end:
             end = self.duration
 
-        if not reverse:
-            position = start
-        else:
-            position = end - duration
+        command = [*FFMPEG_COMMAND, '-ss', str(start),
+                   '-i', self.path, '-t', str(end - start), '-vn',
+                   '-ac', '1', '-ar', str(ar), '-f', 's16le', '-']
 
-        async_result = None
+        ff = Popen(command, stdout=PIPE, close_fds=False)
+        size = round(duration * ar) * 2  # 16-bit mono
+        window = round((duration + overlap) * ar) * 2
 
-        while (position < end) if not reverse else (position > start):
-            result = None
+        try:
+            position = start
+            tail = b''
 
-            if async_result:
-                result = position, async_result.get()[0]
+            while position < end:
+                data = ff.stdout.read(window - len(tail))
 
-                if not reverse:
-                    position += duration
-                else:
-                    position -= duration
+                if not data:
+                    break
 
-                    if position < start:
-                        duration -= start - position
-                        position = start
+                # The overlapping part is decoded only once
+                data = tail + data
+                tail = data[size:]
 
-            async_result = pool.apply_async(self.slice, kwds=kwargs,
-                                            args=(position, duration))
+                yield position, transform(data) if transform else data
+                position += duration
 
-            if not result:
-                continue
+            # Let ffmpeg finish on its own to get a meaningful exit code
+            ff.stdout.read()
 
-            yield result
+            if ff.wait() != 0:
+                raise Exception('ffmpeg exited with non-zero code')
+        finally:
+            ff.stdout.close()
 
-        pool.close()
+            if ff.poll() is None:  # the consumer has stopped early
+                ff.terminate()
+                ff.wait()
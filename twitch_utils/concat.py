@@ -22,6 +22,7 @@ Options:
                                   output file name is specified. [default: mpegts]
   -o <name>, --output=<name>      Name of the output file. Use '-' to output
                                   directly to stdout.
+  -v, --verbose                   Print the concat map to stderr.
 
 MP4 options:
   --faststart   Move moov atom to the front of the file. Requires second pass
@@ -30,13 +31,31 @@ MP4 options:
 
 import os
 import sys
-from typing import List
+import signal
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
 
 from docopt import docopt
-from subprocess import run, PIPE
+from subprocess import Popen, PIPE
 
 from .clip import Clip
-from .utils import tmpfile
+from .utils import FFMPEG
+
+
+# Output formats recognized by the file extension
+OUTPUT_FORMATS = {'.edl': 'edl', '.txt': 'txt', '.ts': 'mpegts',
+                  '.flv': 'flv', '.mp4': 'mp4'}
+
+# ffmpeg options for each output format: (input options, output options)
+FORMAT_OPTIONS = {
+    'mpegts': (['-copyts'], ['-muxdelay', '0']),
+    'flv': ([], ['-bsf:a', 'aac_adtstoasc']),
+    'mp4': ([], ['-fflags', '+genpts', '-async', '1']),
+}
+
+# Formats that can be written to stdout
+PIPE_FORMATS = ('mpegts', 'flv')
 
 
 class TimelineMissingRangeError(Exception):
@@ -47,36 +66,68 @@ class TimelineMissingRangeError(Exception):
         self.end = end
 
 
-class Timeline(list):
-    @staticmethod
-    def find_clip(clips: list, pos: float) -> Clip:
-        abs_start = clips[0].start
-        end = None
-        found = None
+def load_clips(paths: List[str], file=None) -> List[Clip]:
+    """Probe files concurrently, skipping the corrupted ones.
+
+    Warnings are printed to `file` (sys.stderr by default).
+    """
+    if file is None:
+        file = sys.stderr
 
-        for clip in clips:
-            if clip.start <= pos and clip.end > pos:
-                if not found or found.duration < clip.duration:
-                    found = clip
+    def load(path: str) -> Optional[Clip]:
+        try:
+            return Clip(path)
+        except Exception:
+            print(f'WARN: Clip {path} is corrupted, ignoring...', file=file)
+            return None
 
-            if clip.start > pos and not end:
-                end = clip.start
+    if not paths:
+        return []
 
-        if not found:
-            raise TimelineMissingRangeError(pos - abs_start, end - abs_start)
+    with ThreadPoolExecutor(min(32, len(paths))) as pool:
+        return [clip for clip in pool.map(load, paths) if clip]
 
-        return found
 
+class Timeline(list):
     def __init__(self, clips: list):
         clips.sort(key=lambda k: k.start)
 
-        self.start = min([clip.start for clip in clips])
-        self.end = max([clip.end for clip in clips])
+        self.start = clips[0].start
+        self.end = max(clip.end for clip in clips)
+
+        # Clips that may contain the current position, in order of start.
+        # Clips are added once and evicted once, so the sweep is O(N).
+        active: List[Clip] = []
+        starts = [clip.start for clip in clips]
+        i = 0
 
         pos = self.start
         while pos < self.end:
-            self.append(self.find_clip(clips, pos))
-            pos = self[-1].end
+            # Add all clips that have started by now
+            j = bisect_right(starts, pos, i)
+            active += clips[i:j]
+            i = j
+
+            # Evict finished clips and pick the longest remaining one
+            # (the first one on ties) in a single pass
+            found = None
+            remaining = []
+
+            for clip in active:
+                if clip.end > pos:
+                    remaining.append(clip)
+
+                    if not found or found.duration < clip.duration:
+                        found = clip
+
+            active = remaining
+
+            if not found:
+                raise TimelineMissingRangeError(pos - self.start,
+                                                clips[i].start - self.start)
+
+            self.append(found)
+            pos = found.end
 
             if len(self) < 2:
                 continue
@@ -97,17 +148,26 @@ class Timeline(list):
 
             a.outpoint = b.inpoint = middle
 
+    def ffconcat_entries(self, pipe: bool = False) -> Iterator[str]:
+        for c in self:
+            path = c.path
+
+            if pipe and os.path.exists(path):
+                # Relative paths are resolved against the URL of the map,
+                # which doesn't point to any directory when read from stdin
+                path = 'file:' + os.path.abspath(path)
+
+            # Same output as an f-string, but skips format spec parsing
+            yield ("file '" + path + "'\ninpoint " + repr(c.inpoint) +
+                   '\noutpoint ' + repr(c.outpoint) + '\n')
+
     def ffconcat_map(self) -> str:
-        return '\n'.join([
-            f"file '{c.path}'\ninpoint {c.inpoint}\noutpoint {c.outpoint}\n"
-            for c in self
-        ])
+        return '\n'.join(self.ffconcat_entries())
 
-    def edl_parts(self) -> List[str]:
-        return [
-            f"%{len(c.path)}%{c.path},{c.inpoint},{c.outpoint - c.inpoint}"
-            for c in self
-        ]
+    def edl_parts(self) -> Iterator[str]:
+        for c in self:
+            yield (f"%{len(c.path)}%{c.path},"
+                   f"{c.inpoint},{c.outpoint - c.inpoint}")
 
     def edl_uri(self) -> str:
         return 'edl://' + ';'.join(self.edl_parts())
@@ -116,8 +176,14 @@ class Timeline(list):
         return '# mpv EDL v0\n' + '\n'.join(self.edl_parts())
 
     def render(self, path: str = 'full.mp4', container: str = 'mp4',
-               mp4_faststart: bool = False, force: bool = False) -> int:
-        if path.endswith('.edl') or path == '-' and container == 'edl':
+               mp4_faststart: bool = False, force: bool = False,
+               verbose: bool = False) -> int:
+        if path == '-':
+            fmt = container
+        else:
+            fmt = OUTPUT_FORMATS.get(os.path.splitext(path)[1])
+
+        if fmt == 'edl':
             if path == '-':
                 print(self.edl_map())
             else:
@@ -126,73 +192,81 @@ class Timeline(list):
                     fo.flush()
             return 0
 
-        if path == '-' and container == 'edl_uri':
+        if fmt == 'edl_uri':
             print(self.edl_uri())
             return 0
 
-        concat_map = self.ffconcat_map()
-
-        if path.endswith('.txt') or path == '-' and container == 'txt':
+        if fmt == 'txt':
             if path == '-':
-                print(concat_map)
+                print(self.ffconcat_map())
             else:
                 with open(path, 'w') as fo:
-                    fo.write(concat_map)
+                    fo.write(self.ffconcat_map())
                     fo.flush()
             return 0
 
-        print(concat_map, file=sys.stderr)
+        if not force and path != '-' and os.path.exists(path):
+            # ffmpeg can't ask for confirmation while stdin is the map
+            print(f"File '{path}' already exists. Overwrite? [y/N] ",
+                  end='', file=sys.stderr, flush=True)
+
+            if sys.stdin.readline().strip().lower() != 'y':
+                return 1
 
-        map_file_name = tmpfile('txt', '.')
-        map_file = open(map_file_name, 'w')
-        map_file.write(concat_map)
-        map_file.flush()
-        map_file.close()
+            force = True
 
-        command = ['ffmpeg']
+        command = [FFMPEG]
 
         if force:
             command += ['-y']
 
-        if path.endswith('.ts') or path == '-' and container == 'mpegts':
-            command += ['-copyts']
+        input_options, output_options = FORMAT_OPTIONS.get(fmt, ([], []))
 
+        command += input_options
         command += ['-f', 'concat', '-safe', '0', '-hide_banner',
-                    '-i', map_file_name, '-c', 'copy']
+                    '-protocol_whitelist', 'file,pipe,crypto,data',
+                    '-i', 'pipe:', '-c', 'copy']
+        command += output_options
 
-        if path.endswith('.ts') or path == '-' and container == 'mpegts':
-            command += ['-muxdelay', '0']
-            if path == '-':
-                command += ['-f', 'mpegts']
-        elif path.endswith('.flv') or path == '-' and container == 'flv':
-            command += ['-bsf:a', 'aac_adtstoasc']
-            if path == '-':
-                command += ['-f', 'flv']
-        elif path.endswith('.mp4'):
-            command += ['-fflags', '+genpts', '-async', '1']
-            if mp4_faststart:
-                command += ['-movflags', 'faststart']
+        if fmt == 'mp4' and mp4_faststart:
+            command += ['-movflags', 'faststart']
 
-        command += [path]
+        if path == '-' and fmt in PIPE_FORMATS:
+            command += ['-f', fmt]
 
-        p = run(command)
+        command += [path]
 
-        os.unlink(map_file_name)
+        ff = Popen(command, stdin=PIPE, close_fds=False)
 
-        return p.returncode
+        try:
+            # Let ffmpeg start up while the map is being formatted
+            try:
+                with ff.stdin:
+                    for entry in self.ffconcat_entries(pipe=True):
+                        ff.stdin.write((entry + '\n').encode())
+
+                        if verbose:
+                            print(entry, file=sys.stderr)
+            except BrokenPipeError:
+                pass  # ffmpeg has failed, its exit code is returned below
+
+            return ff.wait()
+        except KeyboardInterrupt:
+            # ffmpeg finalizes the output on SIGINT (it may have already
+            # received one from the terminal). Don't leave it running
+            # in the background with a half-written file.
+            if os.name == 'nt':  # SIGINT can't be sent on Windows
+                ff.terminate()
+            else:
+                ff.send_signal(signal.SIGINT)
+            ff.wait()
+            raise
 
 
 def main(argv=None):
     args = docopt(__doc__, argv=argv)
 
-    clips = []
-
-    for path in args['<input>']:
-        try:
-            clips.append(Clip(path))
-        except Exception:
-            print(f'WARN: Clip {path} is corrupted, ignoring...',
-                  file=sys.stderr)
+    clips = load_clips(args['<input>'])
 
     try:
         timeline = Timeline(clips)
@@ -205,7 +279,8 @@ def main(argv=None):
     sys.exit(timeline.render(args['--output'],
                              container=args['--format'],
                              mp4_faststart=args['--faststart'],
-                             force=args['--force']))
+                             force=args['--force'],
+                             verbose=args['--verbose']))
 
 
 if __name__ == '__main__':
@@ -23,17 +23,8 @@ import sys
 from docopt import docopt
 from subprocess import run
 
-try:
-    from spleeter.separator import Separator
-    from spleeter.audio.adapter import AudioAdapter
-except ImportError:
-    print('Error: You need to install tdh-twitch-utils[mute] or '
-          'tdh-twitch-utils[all] to use this feature.',
-          file=sys.stderr)
-    sys.exit(1)
-
 from .clip import Clip
-from .utils import tmpfile
+from .utils import tmpfile, FFMPEG
 
 
 def ptime(t: str) -> float:
@@ -44,6 +35,18 @@ def ptime(t: str) -> float:
 def main(argv=None):
     args = docopt(__doc__, argv=argv)
 
+    # Spleeter pulls in TensorFlow, which takes seconds to import.
+    # Do it after parsing arguments, so that --help stays instant.
+    try:
+        import numpy as np
+        from spleeter.separator import Separator
+        from spleeter.audio.adapter import AudioAdapter
+    except ImportError:
+        print('Error: You need to install tdh-twitch-utils[mute] or '
+              'tdh-twitch-utils[all] to use this feature.',
+              file=sys.stderr)
+        sys.exit(1)
+
     fi = Clip(args['<input>'])
     fo = args['-o']
     ranges = list(tuple(ptime(t) for t in range.split('~'))
@@ -67,24 +70,21 @@ def main(argv=None):
     ranges = new_ranges
     segments = {}
 
+    target = 'accompaniment' if args['--inverse'] else 'vocals'
+
     for start, end in ranges:
         print(f'Processing range {start}-{end}...')
 
-        options = ['-vn', '-r', str(sample_rate), '-f', 'wav']
-        clip = fi.slice(start, end - start, output_options=options)[0]
+        # Same layout as AudioAdapter.load(), but without a temporary file
+        pcm = fi.read_pcm(start, end - start, sample_rate, ac=2, fmt='f32le')
+        waveform = np.frombuffer(pcm, dtype=np.float32).reshape(-1, 2)
 
         for i in range(int(args['--pass'])):
-            waveform, _ = loader.load(clip.path, sample_rate=sample_rate)
-            prediction = separator.separate(waveform)
-
-            output = tmpfile('wav')
-
-            target = 'accompaniment' if args['--inverse'] else 'vocals'
-            loader.save(output, prediction[target], sample_rate)
-
-            clip = Clip(output, tmpfile=output)
+            waveform = separator.separate(waveform)[target]
 
-        segments[start] = clip
+        output = tmpfile('wav')
+        loader.save(output, waveform, sample_rate)
+        segments[start] = Clip(output, tmpfile=output)
 
     print('Writing output file...')
 
@@ -111,13 +111,13 @@ def main(argv=None):
 
     filters += '[audio]'
 
-    command = ['ffmpeg', '-i', fi.path]
+    command = [FFMPEG, '-i', fi.path]
 
     for start, segment in segments.items():
         command += ['-i', segment.path]
 
     # Copy codecs from the original video
-    ainfo = fi.ffprobe('stream=codec_name,bit_rate', 'a')['streams'][0]
+    ainfo = fi.audio_streams[0]
     command += ['-c:v', 'copy',
                 '-c:a', ainfo['codec_name'],
                 '-b:a', ainfo['bit_rate'],
@@ -126,7 +126,7 @@ def main(argv=None):
     command += ['-filter_complex', filters,
                 '-map', '0:v', '-map', '[audio]', fo]
 
-    if run(command).returncode != 0:
+    if run(command, close_fds=False).returncode != 0:
         if os.path.exists(fo):
             os.unlink(fo)
         raise Exception('ffmpeg exited with non-zero code')
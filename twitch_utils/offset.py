@@ -9,10 +9,12 @@ Video, subtitles and metadata will be ignored.
 Options:
   -s <t>, --start <t>       Skip <t> seconds at the beggining of FILE2. [default: 0]
   -e <t>, --end <t>         Stop matching at this offset of FILE2.
-  -t <t>, --split <t>       Split FILE2 into chunks of this length. [default: 300]
+  -t <t>, --split <t>       Split FILE2 into chunks of this length. Chunks overlap
+                            by the template duration, so matches on chunk
+                            boundaries are not missed. [default: 300]
   --template-start <t>      Template chunk will be cut from FILE1 starting at this offset. [default: 0]
   --template-duration <t>   Duration of template chunk. [default: 120]
-  -r <frequency>            WAV sampling frequency (lower is faster but less accurate). [default: 1000]
+  -r <frequency>            Audio sampling frequency (lower is faster but less accurate). [default: 1000]
   --reverse                 Start from the end of the video.
 
 Exit conditions:
@@ -43,37 +45,63 @@ Usage examples:
   offset.py $(youtube-dl -gf best VIDEO_ID) long_video.mp4
 """
 
+import os
 import sys
 
 try:
-    import parselmouth as pm
+    import numpy as np
+    from scipy.fft import rfft, irfft, next_fast_len
 except ImportError:
     print('Error: You need to install tdh-twitch-utils[offset] or '
           'tdh-twitch-utils[all] to use this feature.',
           file=sys.stderr)
     sys.exit(1)
 
-from typing import Tuple
+from typing import Dict, Tuple
 from docopt import docopt
 
 from .clip import Clip
 
 
-def offset(template: Clip, video: Clip) -> Tuple[float, float]:
-    """Find position of this Clip in another Clip (may be negative).
+def load_pcm(data: bytes) -> np.ndarray:
+    """Convert output of Clip.read_pcm() into float samples in [-1, 1)."""
+    return np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768
+
+
+def offset(template: np.ndarray, video: np.ndarray, ar: int,
+           spectra: Dict[int, np.ndarray] = None,
+           workers: int = -1) -> Tuple[float, float]:
+    """Find position of one mono signal in another (may be negative).
 
     Returns two values: offset in seconds and cross-correlation score.
+    If the same template is matched repeatedly, pass the same `spectra`
+    dict to reuse its FFT between calls. `workers` is the number of
+    threads used by each FFT (all cores by default).
     """
-    s1 = pm.Sound(template.path).convert_to_mono()
-    s2 = pm.Sound(video.path).convert_to_mono()
-    cc = s1.cross_correlate(s2, pm.AmplitudeScaling.SUM)
-    score = cc.values.max()
-    frame = cc.values.argmax()
-    offset = cc.frame_number_to_time(frame)
+    a, b = template, video
+
+    if spectra is None:
+        spectra = {}
+
+    # Cross-correlation via FFT, equivalent to np.correlate(b, a, 'full')
+    # and to Praat's cross_correlate with AmplitudeScaling.SUM
+    length = len(a) + len(b) - 1
+    n = next_fast_len(length, real=True)
+
+    if n not in spectra:
+        spectra[n] = rfft(a[::-1], n, workers=workers)
+
+    # The product is a temporary, so the inverse FFT may work in place
+    cc = irfft(rfft(b, n, workers=workers) * spectra[n], n,
+               workers=workers, overwrite_x=True)
+
+    frame = cc[:length].argmax()
+    score = cc[frame]
+    offset = (frame - len(a) + 1) / ar
     return offset, score
 
 
-def find_offset(c1: Clip, c2: Clip,
+def find_offset(template: np.ndarray, c2: Clip,
                 start: float = 0, end: float = None, reverse: bool = False,
                 chunk_size: float = 300,
                 ar: int = 500,
@@ -86,12 +114,32 @@ def find_offset(c1: Clip, c2: Clip,
     best_offset, best_score = 0, 0
     prev_score = 0
 
+    # Template spectrum by FFT size. All chunks except the last one have
+    # the same length, so the template is transformed only once or twice.
+    spectra: Dict[int, np.ndarray] = {}
+
+    # Chunks are correlated right in the threads that decode them, so
+    # each FFT is limited to one core to avoid oversubscription
+    def correlate(chunk: bytes, workers: int = 1) -> Tuple[float, float]:
+        return offset(template, load_pcm(chunk), ar, spectra, workers)
+
+    # Extend each chunk by the template length, so that a match that
+    # crosses the chunk boundary is fully contained in one of the chunks
+    overlap = len(template) / ar
+
     print(f'pos | offset | score | mul', file=sys.stderr)
 
-    for position, chunk in c2.slice_generator(
-            chunk_size, start, end, reverse,
-            output_options=['-vn', '-ar', str(ar)]):
-        new_offset, new_score = offset(c1, chunk)
+    if reverse or os.path.isfile(c2.path):
+        chunks = c2.pcm_generator(chunk_size, ar, start, end, reverse,
+                                  transform=correlate, overlap=overlap)
+    else:
+        # Seeking in remote inputs is slow, read them in one pass instead.
+        # Chunks are correlated one at a time here, so use all cores.
+        chunks = c2.pcm_stream(chunk_size, ar, start, end,
+                               transform=lambda chunk: correlate(chunk, -1),
+                               overlap=overlap)
+
+    for position, (new_offset, new_score) in chunks:
 
         delta = new_score - prev_score
         prev_score = new_score
@@ -149,8 +197,8 @@ def main(argv=None):
     if c1.duration < template_start or template_duration <= 0:
         raise Exception('Template is empty (check start offset and duration)')
 
-    c1 = c1.slice(template_start, template_duration + template_start,
-                  output_options=['-vn', '-ar', str(ar)])[0]
+    template = load_pcm(c1.read_pcm(template_start,
+                                    template_duration + template_start, ar))
 
     c2 = Clip(args['FILE2'])
 
@@ -165,7 +213,7 @@ def main(argv=None):
         'reverse': args['--reverse']
     }
 
-    offset, score = find_offset(c1, c2, **kwargs)
+    offset, score = find_offset(template, c2, **kwargs)
 
     if offset == 0 and score == 0:
         raise Exception('Videos are not correlated or min-score is too high')
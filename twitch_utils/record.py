@@ -25,15 +25,14 @@ Options:
 """
 
 import os
+import re
 import sys
 import math
-import itertools
 from datetime import datetime
 from typing import Dict, Union, Any
 
 try:
     import streamlink
-    from parse import compile
 except ImportError:
     print('Error: You need to install tdh-twitch-utils[record] or '
           'tdh-twitch-utils[all] to use this feature.',
@@ -42,20 +41,22 @@ except ImportError:
 
 from time import sleep
 from docopt import docopt
-from subprocess import Popen, PIPE
-from multiprocessing import Process
+from threading import Thread
+from subprocess import Popen, PIPE, DEVNULL
 
 from .clip import Clip
-from .concat import Timeline, TimelineMissingRangeError
+from .concat import Timeline, TimelineMissingRangeError, load_clips
 from .twitch import TwitchAPI
+from .utils import STREAMLINK
 
 
 DEBUG = False
 
 
 class Stream(object):
-    PARSE_QUEUED = compile('{} Adding segment {segment:d} to queue{}')
-    PARSE_COMPLETE = compile('{} Segment {segment:d} complete{}')
+    # Group 1 is set for queued segments, group 2 for completed ones
+    PARSE_SEGMENT = re.compile(r' (?:Adding segment (\d+) to queue'
+                               r'|Segment (\d+) complete)')
 
     def __init__(self, url: str,
                  quality: str = 'best',
@@ -107,19 +108,32 @@ class Stream(object):
         exit_code = 0
 
         fo = open(dest, 'wb')
-        sl_cmd = ['streamlink'] + self._args()
+
+        # Recordings are written once and won't be read again until
+        # concatenation, so don't let them fill the page cache
+        fadvise = hasattr(os, 'posix_fadvise')
+        advised, completed = 0, 0  # offsets in the output file
+
+        sl_cmd = [STREAMLINK] + self._args()
         sl_env = {**os.environ, 'PYTHONUNBUFFERED': '1'}
-        sl_kwargs = {'stdout': fo,
+        sl_kwargs = {'stdin': DEVNULL,
+                     'stdout': fo,
                      'stderr': PIPE,
                      'text': True,
-                     'env': sl_env}
+                     'env': sl_env,
+                     'bufsize': 1 << 16,
+                     'close_fds': False}
         sl_proc = Popen(sl_cmd, **sl_kwargs)
 
         expected, downloaded = [-1] * 2
         first_segment = True
 
+        # Called for every line of streamlink's output
+        readline = sl_proc.stderr.readline
+        parse_segment = Stream.PARSE_SEGMENT.search
+
         while True:
-            line = sl_proc.stderr.readline()
+            line = readline()
 
             if not line:
                 break
@@ -127,16 +141,19 @@ class Stream(object):
             if DEBUG:
                 print(line.rstrip(), file=sys.stderr)
 
-            queued = Stream.PARSE_QUEUED.parse(line)
-            complete = Stream.PARSE_COMPLETE.parse(line)
+            # Most lines are unrelated debug messages, skip the regex for
+            # them with a plain substring test
+            match = 'egment ' in line and parse_segment(line)
+            queued = match and match.group(1)
+            complete = match and match.group(2)
 
             if queued:
-                segment = queued['segment']
+                segment = int(queued)
 
-                if queued['segment'] > expected:
-                    expected = queued['segment']
+                if segment > expected:
+                    expected = segment
             elif complete:
-                segment = complete['segment']
+                segment = int(complete)
 
                 if self.live and first_segment:
                     # Log precise timings to leave some traces for manual
@@ -152,6 +169,18 @@ class Stream(object):
 
                 if downloaded == -1 or downloaded + 1 == segment:
                     downloaded = segment
+
+                    if fadvise:
+                        # DONTNEED starts writeback of dirty pages and
+                        # drops clean ones. Lag by one segment, so that
+                        # the advised range is mostly written back already.
+                        if completed > advised:
+                            os.posix_fadvise(fo.fileno(), advised,
+                                             completed - advised,
+                                             os.POSIX_FADV_DONTNEED)
+                            advised = completed
+
+                        completed = os.fstat(fo.fileno()).st_size
                 else:
                     print(f'ERR: Skipped segment {downloaded + 1}')
                     sl_proc.terminate()
@@ -181,32 +210,38 @@ class Stream(object):
 
         return exit_code
 
-    def _target_download(self, *args):
-        result = self.download(*args)
-        sys.exit(result)
+    def download_async(self, dest: str) -> 'DownloadThread':
+        t = DownloadThread(self, dest)
+        t.start()
+        return t
 
-    def download_async(self, dest: str) -> Process:
-        p = Process(target=self._target_download, args=(dest,))
-        p.start()
-        return p
 
+class DownloadThread(Thread):
+    """Runs Stream.download() in background. The actual work is done by
+    streamlink, so a thread is enough. Exit code is stored in `exitcode`
+    (None while running) like in multiprocessing.Process."""
 
-def generate_filename(vod_id, part):
-    return f'{vod_id}.{part}.ts'
+    def __init__(self, stream: Stream, dest: str):
+        super().__init__()
+        self.stream = stream
+        self.dest = dest
+        self.exitcode: Union[int, None] = None
 
+    def run(self):
+        try:
+            self.exitcode = self.stream.download(self.dest)
+        except BaseException:
+            self.exitcode = 1
+            raise
 
-def create_timeline(vod_id, parts):
-    clips = []
 
-    for part in range(parts):
-        filename = generate_filename(vod_id, part)
+def generate_filename(vod_id, part):
+    return f'{vod_id}.{part}.ts'
 
-        try:
-            clips.append(Clip(filename))
-        except Exception:
-            print(f'WARN: Clip {filename} is corrupted, ignoring...')
 
-    return Timeline(clips)
+def create_timeline(vod_id, parts):
+    filenames = [generate_filename(vod_id, part) for part in range(parts)]
+    return Timeline(load_clips(filenames, file=sys.stdout))
 
 
 def record(channel_name: str, vod_id: str, vod_url: Union[str, None] = None,
@@ -242,18 +277,15 @@ def record(channel_name: str, vod_id: str, vod_url: Union[str, None] = None,
         stream_proc = stream.download_async(generate_filename(vod_id, parts))
         parts += 1
 
-        should_break = False
-        for i in range(60):
-            if stream_proc.exitcode == 2:
-                if parts == 1:
-                    sys.exit(1)
-                else:
-                    should_break = True
-                    break
-            sleep(1)
+        # Give the stream a minute to start, but don't wait for nothing
+        # if streamlink exits earlier
+        stream_proc.join(60)
 
-        if should_break:
-            break
+        if stream_proc.exitcode == 2:
+            if parts == 1:
+                sys.exit(1)
+            else:
+                break
 
         if parts == 1:
             print('Starting download of VOD')
@@ -308,11 +340,9 @@ def record(channel_name: str, vod_id: str, vod_url: Union[str, None] = None,
             parts += 1
 
             vod_proc.join()
-            vod_proc.close()
 
         stream_proc.join()
         stream_result = stream_proc.exitcode
-        stream_proc.close()
 
         print(f'Finished download of live stream (exit code: {stream_result})')
 
@@ -380,14 +410,15 @@ def main(argv=None):
 
     parts = 0
 
-    for i in itertools.count():
-        if os.path.exists(generate_filename(vod, i)):
-            if i == 0:
-                print('Found previous segments, resuming download')
+    # Read the directory once instead of checking each part separately
+    with os.scandir('.') as entries:
+        existing = set(entry.name for entry in entries)
 
-            parts = i + 1
-        else:
-            break
+    while generate_filename(vod, parts) in existing:
+        parts += 1
+
+    if parts > 0:
+        print('Found previous segments, resuming download')
 
     parts = record(channel, vod, vod_url, args['--quality'], args['-j'], parts, api, stream)
 
@@ -403,10 +434,14 @@ def main(argv=None):
             output = f'{vod}.ts'
 
         print(f'Writing stream recording to {output}')
-        t.render(output, force=args['--force'])
+        t.render(output, force=args['--force'], verbose=DEBUG)
 
         print('Cleaning up...')
-        [os.unlink(generate_filename(vod, part)) for part in range(parts)]
+        for part in range(parts):
+            try:
+                os.unlink(generate_filename(vod, part))
+            except FileNotFoundError:
+                pass
     else:
         if not output:
             output = f'{vod}.mp4'
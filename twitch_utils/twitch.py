@@ -1,5 +1,11 @@
+try:
+    import orjson as json
+except ImportError:
+    import json
+
 from typing import Any, Dict, Union, List
-from requests import Session
+from requests import Session, head
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from hashlib import sha1
 from urllib.parse import urlparse
@@ -74,7 +80,7 @@ class TwitchAPI:
         res = self.session.post('https://gql.twitch.tv/gql', json={'query': query})
 
         if res.status_code == 200:
-            return res.json()
+            return json.loads(res.content)
         else:
             raise Exception(res.text)
 
@@ -174,13 +180,29 @@ class TwitchAPI:
         predicted_domain = self.vod_probe_domain(login)
         domains = sorted(VOD_DOMAINS, key=lambda x: x != predicted_domain)
 
-        for domain in domains:
-            url = f'https://{domain}{path}'
-            res = self.session.head(url, timeout=5)
-            print(f'[{res.status_code}] {url}')
+        urls = [f'https://{domain}{path}' for domain in domains]
 
-            if res.status_code == 200:
-                return url
+        # Probe all domains at once, but check results in order of
+        # preference. Session is not thread-safe, so each probe makes
+        # a standalone request with the same headers.
+        headers = self.get_headers()
+        pool = ThreadPoolExecutor(8)
+        probes = [pool.submit(head, url, headers=headers, timeout=5)
+                  for url in urls]
+
+        try:
+            for url, probe in zip(urls, probes):
+                res = probe.result()
+                print(f'[{res.status_code}] {url}')
+
+                if res.status_code == 200:
+                    return url
+        finally:
+            # Drop the queued probes and don't wait for running ones
+            for probe in probes:
+                probe.cancel()
+
+            pool.shutdown(wait=False)
 
         raise Exception('VOD not found')
 
@@ -1,8 +1,40 @@
 import os
+import atexit
+import shutil
 import tempfile
+import itertools
+
+from threading import Lock
+
+
+# External tools are looked up in PATH once. Passing an absolute path
+# to subprocess saves a PATH search on every call and, together with
+# close_fds=False, lets CPython start them with posix_spawn(). Not
+# closing fds is safe, because descriptors opened by Python are
+# non-inheritable anyway (PEP 446).
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE = shutil.which('ffprobe') or 'ffprobe'
+STREAMLINK = shutil.which('streamlink') or 'streamlink'
+
+_tmpdir = None
+_tmpdir_lock = Lock()
+_tmpfile_counter = itertools.count()
+
+
+def _private_tmpdir() -> str:
+    """Directory for temporary files of this process, removed on exit."""
+    global _tmpdir
+
+    with _tmpdir_lock:
+        if not _tmpdir:
+            _tmpdir = tempfile.mkdtemp(prefix='twitch_utils-')
+            atexit.register(shutil.rmtree, _tmpdir, ignore_errors=True)
+
+    return _tmpdir
 
 
 def tmpfile(ext='tmp', path=None):
     if not path:
-        path = tempfile.gettempdir()
-    return os.path.join(path, os.urandom(24).hex() + '.' + ext)
\ No newline at end of file
+        name = f'{next(_tmpfile_counter):06d}.{ext}'
+        return os.path.join(_private_tmpdir(), name)
+    return os.path.join(path, os.urandom(24).hex() + '.' + ext)